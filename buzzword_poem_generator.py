@@ -8,14 +8,23 @@ from __future__ import print_function
 
 import argparse
 import copy
+import errno
+import heapq
 import itertools
+import multiprocessing
 import os
 import pickle
 import random
-from collections import Counter
+import shutil
+import sys
+import time
+from collections import Counter, deque
 
 
 MAX_TRIES = 100
+# chunks of precomputed combinations per process, and min number of combinations in chunk to split it
+CHUNKS_PER_PROCESS = 4
+MIN_CHUNK_SIZE = 10000
 
 WORDS_METRICAL_FEET = {
     # / - ictus (stressed syllable), x - nonictus (unstressed syllable)
@@ -274,74 +283,394 @@ def is_rhyme(words, rhymes):
     return False
 
 
+def get_syllables_combinations_filename(syllables_words, syllables_num):
+    """Get the name of cache file with combinations of `syllables_num` for syllables keys"""
+    # calc syllables keys hash
+    syllables_keys = sorted([0] + list(syllables_words.keys()))
+    keys_hash = hash(tuple(syllables_keys)) & 0xffffffff
+    return 'compositions_{}_{}.dat'.format(keys_hash, syllables_num)
+
+
+def build_syllables_combinations(syllables_words, syllables_num, prefix=()):
+    """
+    Build all possible compositions of `syllables_num` with the parts from syllables keys,
+    only the ones starting with `prefix` parts if it is set
+    """
+    syllables_keys = sorted(x for x in syllables_words if x > 0)
+    rest_num = syllables_num - sum(prefix)
+    if rest_num < 0 or any(x not in syllables_keys for x in prefix):
+        return []
+    # combinations[n] is the list of all compositions of n, i.e. each part k followed by compositions of n - k
+    combinations = [[[]]]
+    for n in range(1, rest_num + 1):
+        combinations.append([[k] + x for k in syllables_keys if k <= n for x in combinations[n - k]])
+    if prefix:
+        return [list(prefix) + x for x in combinations[rest_num]]
+    return combinations[rest_num]
+
+
+def replace_file(src, dst):
+    """Rename `src` file to `dst`, replacing the existing one"""
+    if hasattr(os, 'replace'):
+        os.replace(src, dst)
+    else:
+        # os.rename can't replace the existing file on Windows
+        if os.path.isfile(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+
+
+def save_syllables_combinations(fn, combinations):
+    """Save combinations to cache file, replacing the existing one"""
+    # write to temporary file first, not to leave a partially written cache file
+    tmp_fn = '{}.{}.tmp'.format(fn, os.getpid())
+    with open(tmp_fn, 'wb') as f:
+        pickle.dump(combinations, f, protocol=2)
+    replace_file(tmp_fn, fn)
+
+
+def load_syllables_combinations(fn):
+    """Load combinations from cache file, i.e. from the sequence of pickled lists of combinations"""
+    combinations = []
+    size = os.path.getsize(fn)
+    with open(fn, 'rb') as f:
+        while f.tell() < size:
+            combinations.extend(pickle.load(f))
+    return combinations
+
+
 def get_syllables_combinations(syllables_words, syllables_num, use_cache=True):
     """
     Get all possible compositions of `syllables_num`, i.e. all combinations,
     where a sum of positive integers is equal to `syllables_num`
     """
-    # calc syllables keys hash
-    syllables_keys = sorted([0] + list(syllables_words.keys()))
-    keys_hash = hash(tuple(syllables_keys)) & 0xffffffff
-    combinations = []
     # if already computed and cache is used - load combinations from file
-    fn = 'compositions_{}_{}.dat'.format(keys_hash, syllables_num)
+    fn = get_syllables_combinations_filename(syllables_words, syllables_num)
     if os.path.isfile(fn) and use_cache:
-        with open(fn, 'rb') as f:
-            combinations = pickle.load(f)
+        combinations = load_syllables_combinations(fn)
     else:
-        for v in itertools.product(syllables_keys, repeat=syllables_num):
-            if sum(v) == syllables_num:
-                fv = [x for x in v if x]
-                if fv not in combinations:
-                    combinations.append(fv)
+        combinations = build_syllables_combinations(syllables_words, syllables_num)
         if use_cache:
-            with open('compositions_{}_{}.dat'.format(keys_hash, syllables_num), 'wb') as f:
-                pickle.dump(combinations, f, protocol=2)
+            save_syllables_combinations(fn, combinations)
     return combinations
 
 
-def generate_poem(rhyme_scheme, syllables_in_lines, min_words_in_line, use_cache):
-    """Generate poem"""
+def count_syllables_combinations(syllables_words, syllables_num):
+    """Count all possible compositions of `syllables_num` with the parts from syllables keys"""
+    syllables_keys = [x for x in syllables_words if x > 0]
+    # counts[n] is the number of compositions of n
+    counts = [1] + [0] * syllables_num
+    for n in range(1, syllables_num + 1):
+        counts[n] = sum(counts[n - k] for k in syllables_keys if k <= n)
+    return counts[syllables_num]
+
+
+def split_syllables_combinations(syllables_words, syllables_num, chunks_num, min_chunk_size=MIN_CHUNK_SIZE):
+    """
+    Split the compositions of `syllables_num` into chunks by their prefixes, i.e. the first parts
+    of compositions. The largest chunk is split while it has more compositions than 1 / `chunks_num`
+    of all compositions and than `min_chunk_size`. Return the sorted list of prefixes
+    """
+    syllables_keys = sorted(x for x in syllables_words if x > 0)
+    max_chunk_size = max(count_syllables_combinations(syllables_words, syllables_num) // chunks_num, min_chunk_size)
+    # heap of (-chunk size, prefix), to split the largest chunk first
+    chunks = [(-count_syllables_combinations(syllables_words, syllables_num), ())]
+    while True:
+        size, prefix = chunks[0]
+        rest_num = syllables_num - sum(prefix)
+        # the chunk of the only composition equal to the prefix can't be split
+        if -size <= max_chunk_size or rest_num == 0:
+            break
+        heapq.heappop(chunks)
+        for k in syllables_keys:
+            if k <= rest_num:
+                heapq.heappush(chunks, (-count_syllables_combinations(syllables_words, rest_num - k), prefix + (k,)))
+    return sorted(x[1] for x in chunks)
+
+
+def verify_syllables_combinations(syllables_words, syllables_num, combinations):
+    """
+    Check the combinations are all compositions of `syllables_num` for syllables keys,
+    i.e. all of them are valid, unique, and none is missing
+    """
+    unique_combinations = set()
+    for combination in combinations:
+        if sum(combination) != syllables_num or any(x not in syllables_words for x in combination):
+            return False
+        unique_combinations.add(tuple(combination))
+    return len(unique_combinations) == len(combinations) == count_syllables_combinations(
+        syllables_words, syllables_num)
+
+
+def verify_syllables_combinations_entry(entry):
+    """
+    Verify the cache file with combinations for (syllables_words, syllables_num) entry
+    Return (file name, status, time, size), where status is 'verified', 'missing' or 'invalid'
+    """
+    syllables_words, syllables_num = entry
+    start_time = time.time()
+    fn = get_syllables_combinations_filename(syllables_words, syllables_num)
+    if not os.path.isfile(fn):
+        return fn, 'missing', time.time() - start_time, 0
     try:
-        # build map of {syllables: words with syllables}
-        syllables_words = invert_map(WORDS_SYLLABLES)
+        combinations = load_syllables_combinations(fn)
+        valid = verify_syllables_combinations(syllables_words, syllables_num, combinations)
+    except Exception:
+        valid = False
+    return fn, 'verified' if valid else 'invalid', time.time() - start_time, os.path.getsize(fn)
 
-        if len(rhyme_scheme) != len(syllables_in_lines):
-            raise Exception('The rhyme scheme size is not equal to number of syllables in lines!')
-        if sum(syllables_in_lines) > sum(WORDS_SYLLABLES.values()):
-            raise Exception('The sum of syllables in lines is more than sum of all syllables in available words!')
 
-        syl_combinations = {
-            syls: get_syllables_combinations(syllables_words, syls, use_cache) for syls in syllables_in_lines}
+def build_syllables_combinations_chunk(chunk):
+    """
+    Build the combinations for (syllables_words, syllables_num, prefix, part file name) chunk
+    and save them to the part file. Return (chunk, start time, end time)
+    """
+    start_time = time.time()
+    syllables_words, syllables_num, prefix, part_fn = chunk
+    with open(part_fn, 'wb') as f:
+        pickle.dump(build_syllables_combinations(syllables_words, syllables_num, prefix), f, protocol=2)
+    return chunk, start_time, time.time()
 
-        # try to find poem in MAX_TRIES tries
-        try_number = 0
+
+def precompute_syllables_combinations(lexicons, syllables_nums, processes=None):
+    """
+    Precompute cache files with combinations for each lexicon (a map of {syllables: words})
+    and number of syllables, using `processes` processes (all CPUs by default)
+    Existing cache files are verified, missing and invalid ones are built and saved by the processes
+    in chunks split by the prefixes of compositions, and the saved chunks are joined into cache file.
+    Return the list of (file name, status, time, size)
+    """
+    # skip duplicated entries, i.e. lexicons with the same syllables keys
+    entries = {}
+    for syllables_words in lexicons:
+        for syllables_num in syllables_nums:
+            fn = get_syllables_combinations_filename(syllables_words, syllables_num)
+            entries.setdefault(fn, (syllables_words, syllables_num))
+    # process the largest entries first, as they take most of the time
+    entries_order = sorted(entries, key=lambda x: entries[x][1], reverse=True)
+    build_statuses = {'missing': 'built', 'invalid': 'rebuilt'}
+    chunks_num = (processes or multiprocessing.cpu_count()) * CHUNKS_PER_PROCESS
+    results = []
+    parts = {}
+    # run in the current process if only one process is required
+    pool = multiprocessing.Pool(processes) if processes != 1 else None
+    imap = pool.imap_unordered if pool else lambda func, items: (func(x) for x in items)
+    try:
+        # verify existing cache files
+        statuses = {}
+        times = {}
+        for fn, status, entry_time, size in imap(
+                verify_syllables_combinations_entry, [entries[x] for x in entries_order]):
+            if status == 'verified':
+                results.append((fn, status, entry_time, size))
+                print('{}: {} in {:.3f} s, {} bytes'.format(*results[-1]))
+                sys.stdout.flush()
+            else:
+                statuses[fn] = build_statuses[status]
+                times[fn] = entry_time
+
+        # split each entry to build into chunks by the prefixes of compositions,
+        # the chunks of the largest entries go first, and the largest chunks go first within an entry
+        chunks = []
+        for fn in entries_order:
+            if fn not in statuses:
+                continue
+            syllables_words, syllables_num = entries[fn]
+            prefixes = split_syllables_combinations(syllables_words, syllables_num, chunks_num)
+            parts[fn] = ['{}.{}.{}.part'.format(fn, os.getpid(), i) for i in range(len(prefixes))]
+            chunks.extend(sorted(
+                [(syllables_words, syllables_num, prefix, part_fn) for prefix, part_fn in zip(prefixes, parts[fn])],
+                key=lambda x: count_syllables_combinations(x[0], x[1] - sum(x[2])), reverse=True))
+
+        # join the saved chunks into cache file when all chunks of an entry are built
+        built_parts = {}
+        chunks_times = {}
+        for chunk, start_time, end_time in imap(build_syllables_combinations_chunk, chunks):
+            fn = get_syllables_combinations_filename(chunk[0], chunk[1])
+            built_parts[fn] = built_parts.get(fn, 0) + 1
+            chunks_times.setdefault(fn, []).extend([start_time, end_time])
+            if built_parts[fn] < len(parts[fn]):
+                continue
+            tmp_fn = '{}.{}.tmp'.format(fn, os.getpid())
+            with open(tmp_fn, 'wb') as f:
+                for part_fn in parts[fn]:
+                    with open(part_fn, 'rb') as part_f:
+                        shutil.copyfileobj(part_f, f)
+            replace_file(tmp_fn, fn)
+            for part_fn in parts.pop(fn):
+                os.remove(part_fn)
+            # entry time is the verification time plus the wall time from the first chunk start till saved
+            entry_time = times[fn] + time.time() - min(chunks_times.pop(fn))
+            results.append((fn, statuses[fn], entry_time, os.path.getsize(fn)))
+            print('{}: {} in {:.3f} s, {} bytes'.format(*results[-1]))
+            sys.stdout.flush()
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+        # remove the part files of not finished entries
+        for part_fn in itertools.chain.from_iterable(parts.values()):
+            if os.path.isfile(part_fn):
+                os.remove(part_fn)
+    return results
+
+
+def find_poem(words_syllables, syllables_words, rhymes, syl_combinations, rhyme_scheme, syllables_in_lines,
+              min_words_in_line):
+    """Try to find poem in MAX_TRIES tries, return an empty list if poem can't be found"""
+    for _ in range(MAX_TRIES + 1):
+        poem_base = find_poem_base(
+            syllables_words, syl_combinations, syllables_in_lines, min_words_in_line=min_words_in_line)
+        if poem_base:
+            poem = fill_poem(words_syllables, syllables_words, rhymes, poem_base, rhyme_scheme)
+            if poem:
+                return poem
+    return []
+
+
+def iter_stanzas(rhyme_scheme, syllables_in_lines, min_words_in_line, use_cache, stanzas_num=None, cooldown=0,
+                 relax_cooldown=False):
+    """
+    Generate poem stanza by stanza, each stanza is a list of lines with the words
+    `rhyme_scheme` is a rhyme scheme or a list of rhyme schemes of stanzas to cycle through (e.g. for sonnet
+    ['ABAB', 'CDCD', 'EFEF', 'GG']), and `syllables_in_lines` are syllables in lines of all these stanzas
+    Words are never reused within a stanza, and `cooldown` sets the number of previous stanzas
+    whose words can't be reused. If `relax_cooldown` is set and the next stanza can't be generated,
+    the cooldown is relaxed by reusing the words of the oldest stanzas.
+    Stop after `stanzas_num` stanzas (endless if None), or when the next stanza can't be generated
+    """
+    # build map of {syllables: words with syllables}
+    syllables_words = invert_map(WORDS_SYLLABLES)
+
+    rhyme_schemes = [rhyme_scheme] if isinstance(rhyme_scheme, str) else list(rhyme_scheme)
+    if sum(len(x) for x in rhyme_schemes) != len(syllables_in_lines):
+        raise Exception('The rhyme scheme size is not equal to number of syllables in lines!')
+    # split syllables in lines to stanzas, i.e. build the list of (rhyme scheme, syllables in lines) specs
+    stanzas_specs = []
+    for scheme in rhyme_schemes:
+        lines_num = sum(len(x[0]) for x in stanzas_specs)
+        stanzas_specs.append((scheme, syllables_in_lines[lines_num:lines_num + len(scheme)]))
+    for _, stanza_syllables in stanzas_specs:
+        if not stanza_syllables:
+            raise Exception('The rhyme scheme of stanza is empty!')
+        if sum(stanza_syllables) > sum(WORDS_SYLLABLES.values()):
+            raise Exception('The sum of syllables in lines is more than sum of all syllables in available words!')
+    if stanzas_num is not None and stanzas_num <= 0:
+        raise Exception('Stanzas number must be greater than or equal to 1!')
+    if cooldown < 0:
+        raise Exception('Cooldown must be greater than or equal to 0!')
+
+    # combinations are computed once and shared by all stanzas
+    syl_combinations = {
+        syls: get_syllables_combinations(syllables_words, syls, use_cache) for syls in set(syllables_in_lines)}
+
+    # sets of the words used in the last `cooldown` stanzas
+    recent_words = deque(maxlen=cooldown)
+    stanza_number = 0
+    while stanzas_num is None or stanza_number < stanzas_num:
+        stanza_scheme, stanza_syllables = stanzas_specs[stanza_number % len(stanzas_specs)]
         while True:
-            if try_number > MAX_TRIES:
-                print("A poem can't be generated :(")
+            # remove recently used words from available words and rhymes
+            used_words = set().union(*recent_words)
+            words_syllables = {k: v for k, v in WORDS_SYLLABLES.items() if k not in used_words}
+            rhymes = [r - used_words for r in RHYMES]
+            stanza = find_poem(
+                words_syllables, invert_map(words_syllables), rhymes, syl_combinations, stanza_scheme,
+                stanza_syllables, min_words_in_line)
+            if stanza:
                 break
-            poem_base = find_poem_base(
-                syllables_words, syl_combinations, syllables_in_lines, min_words_in_line=min_words_in_line)
-            if poem_base:
-                poem = fill_poem(WORDS_SYLLABLES, syllables_words, RHYMES, poem_base, rhyme_scheme)
-                if poem:
-                    print('\n'.join([' '.join(line) for line in poem]))
-                    break
-            try_number += 1
-            continue
+            if not (relax_cooldown and recent_words):
+                return
+            # relax the cooldown - allow to reuse the words of the oldest stanza
+            recent_words.popleft()
+            print('Warning: cooldown is relaxed to {} stanzas'.format(len(recent_words)), file=sys.stderr)
+        recent_words.append(set(sum(stanza, [])))
+        stanza_number += 1
+        yield stanza
+
+
+def generate_poem(rhyme_scheme, syllables_in_lines, min_words_in_line, use_cache, stanzas_num=1, cooldown=0,
+                  relax_cooldown=False):
+    """Generate poem"""
+    try:
+        stanza_number = 0
+        for stanza in iter_stanzas(
+                rhyme_scheme, syllables_in_lines, min_words_in_line, use_cache, stanzas_num, cooldown,
+                relax_cooldown):
+            # separate stanzas with an empty line
+            if stanza_number:
+                print()
+            print('\n'.join([' '.join(line) for line in stanza]))
+            sys.stdout.flush()
+            stanza_number += 1
+        if stanzas_num is None or stanza_number < stanzas_num:
+            print("A poem can't be generated :(")
+    except IOError as ex:
+        if ex.errno != errno.EPIPE:
+            print('Error: {}'.format(ex))
+            return
+        # output is closed (e.g. piped to `head`) - exit quietly, redirecting the rest of output to devnull
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, sys.stdout.fileno())
     except Exception as ex:
         print('Error: {}'.format(ex))
 
 
+def precompute_main(argv):
+    """Main of precompute command"""
+    parser = argparse.ArgumentParser(
+        prog='{} precompute'.format(os.path.basename(sys.argv[0])),
+        description='Precompute cache of syllables combinations')
+    optional = parser._action_groups.pop()
+    required = parser.add_argument_group('required arguments')
+    required.add_argument(
+        '-s', dest='syllables_range', type=int, nargs=2, metavar=('MIN_SYLLABLES', 'MAX_SYLLABLES'),
+        help='range of syllables in lines (e.g.: 1 12)', required=True)
+    parser.add_argument(
+        '-l', dest='lexicons', type=str, action='append',
+        help='syllables in words of lexicon (e.g.: 1,2,3), can be repeated (buzzwords by default)', required=False)
+    parser.add_argument(
+        '-j', dest='processes', type=int,
+        help='number of processes (number of CPUs by default)', default=None, required=False)
+    parser._action_groups.append(optional)
+
+    args = parser.parse_args(argv)
+    min_syllables, max_syllables = args.syllables_range
+    if min_syllables < 0:
+        parser.error('min syllables must be greater than or equal to 0')
+    if min_syllables > max_syllables:
+        parser.error('min syllables must be less than or equal to max syllables')
+    if args.processes is not None and args.processes < 1:
+        parser.error('number of processes must be greater than or equal to 1')
+    lexicons = []
+    for lexicon in args.lexicons or []:
+        syllables = [x.strip() for x in lexicon.split(',')]
+        if not all(x.isdigit() and int(x) > 0 for x in syllables):
+            parser.error('syllables in words of lexicon must be positive integers: {}'.format(lexicon))
+        lexicons.append({int(x): [] for x in syllables})
+    if not lexicons:
+        lexicons = [invert_map(WORDS_SYLLABLES)]
+
+    start_time = time.time()
+    results = precompute_syllables_combinations(lexicons, range(min_syllables, max_syllables + 1), args.processes)
+    print('Total: {} entries, {} bytes in {:.3f} s'.format(
+        len(results), sum(x[3] for x in results), time.time() - start_time))
+
+
 def main():
     """Main"""
+    if sys.argv[1:2] == ['precompute']:
+        precompute_main(sys.argv[2:])
+        return
     # prepare argument parser, add required arguments group before optional arguments
-    parser = argparse.ArgumentParser(description='Buzzword poem generator')
+    parser = argparse.ArgumentParser(
+        description='Buzzword poem generator',
+        epilog='use "%(prog)s precompute -h" to see how to precompute cache of syllables combinations')
     optional = parser._action_groups.pop()
     required = parser.add_argument_group('required arguments')
     required.add_argument(
-        '-r', dest='rhyme_scheme', type=str,
-        help='rhyme scheme (e.g.: ABAB, AABB)', required=True)
+        '-r', dest='rhyme_scheme', type=str, nargs='+',
+        help='rhyme scheme, or rhyme schemes of stanzas (e.g.: ABAB, AABB, ABAB CDCD EFEF GG)', required=True)
     required.add_argument(
         '-s', dest='syllables_in_lines', type=int, nargs='+',
         help='syllables in lines (e.g.: 7 6 7 6)', required=True)
@@ -351,6 +680,17 @@ def main():
     parser.add_argument(
         '-c', dest='cache', type=str,
         help='use cache (True by default)', default='1', required=False)
+    parser.add_argument(
+        '-n', dest='stanzas_num', type=int,
+        help='number of stanzas, 0 for endless stream (number of rhyme schemes by default)', default=None,
+        required=False)
+    parser.add_argument(
+        '-w', dest='cooldown', type=int,
+        help='number of previous stanzas whose words are not reused (0 by default)', default=0, required=False)
+    parser.add_argument(
+        '-x', dest='relax_cooldown', type=str,
+        help="reuse words of the oldest stanzas if the next stanza can't be generated (False by default)",
+        default='0', required=False)
     parser._action_groups.append(optional)
 
     args = parser.parse_args()
@@ -362,8 +702,12 @@ def main():
     syllables_in_lines = args.syllables_in_lines
     min_words_in_line = args.min_words_in_line
     use_cache = args.cache.lower() in ['1', 'true', 't', 'on']
+    stanzas_num = len(rhyme_scheme) if args.stanzas_num is None else args.stanzas_num or None
+    cooldown = args.cooldown
+    relax_cooldown = args.relax_cooldown.lower() in ['1', 'true', 't', 'on']
 
-    generate_poem(rhyme_scheme, syllables_in_lines, min_words_in_line, use_cache)
+    generate_poem(
+        rhyme_scheme, syllables_in_lines, min_words_in_line, use_cache, stanzas_num, cooldown, relax_cooldown)
 
 
 if __name__ == '__main__':
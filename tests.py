@@ -1,10 +1,20 @@
 #!/usr/bin/env python
 # -*- coding: utf8 -*-
 
+import itertools
+import os
+import pickle
+import subprocess
+import sys
 import unittest
 from buzzword_poem_generator import (
+    WORDS_SYLLABLES,
     invert_map, find_poem_base, get_rhyme_words_from_syllables_num,
-    get_rhyme_words_groups, fill_poem, is_rhyme, get_syllables_combinations, generate_poem,
+    get_rhyme_words_groups, fill_poem, is_rhyme, get_syllables_combinations, find_poem, iter_stanzas, generate_poem,
+    get_syllables_combinations_filename, build_syllables_combinations, save_syllables_combinations,
+    count_syllables_combinations, verify_syllables_combinations, verify_syllables_combinations_entry,
+    build_syllables_combinations_chunk, precompute_syllables_combinations, split_syllables_combinations,
+    load_syllables_combinations,
 )
 
 
@@ -279,6 +289,232 @@ class TestBuzzwordPoemGenerator(unittest.TestCase):
         generate_poem('A', [1], 3, False)
         generate_poem('ABC', [1], 0, False)
         generate_poem('A', [99999], 0, False)
+        # several stanzas
+        generate_poem('AB', [3, 3], 1, False, 3, 1)
+        # stream stops when the next stanza can't be generated
+        generate_poem('AAA', [1, 1, 1], 1, False, None, 10, True)
+
+    def test_generate_poem_broken_pipe(self):
+        """Test generate_poem exits quietly when the output is closed"""
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'buzzword_poem_generator.py')
+        process = subprocess.Popen(
+            [sys.executable, script, '-r', 'AA', '-s', '1', '1', '-n', '0', '-c', '0'],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        process.stdout.readline()
+        process.stdout.close()
+        stderr = process.stderr.read()
+        process.stderr.close()
+        self.assertEqual(process.wait(), 0)
+        self.assertEqual(stderr, b'')
+
+    def test_count_syllables_combinations(self):
+        """Test count_syllables_combinations function"""
+        syllables_words = {1: ['One'], 2: ['Seven'], 3: ['Eleven']}
+        self.assertEqual(count_syllables_combinations(syllables_words, 0), 1)
+        self.assertEqual(count_syllables_combinations(syllables_words, 1), 1)
+        self.assertEqual(count_syllables_combinations(syllables_words, 3), 4)
+        for syllables_num in range(8):
+            self.assertEqual(
+                count_syllables_combinations(syllables_words, syllables_num),
+                len(get_syllables_combinations(syllables_words, syllables_num, use_cache=False)))
+        self.assertEqual(count_syllables_combinations({}, 3), 0)
+
+    def test_build_syllables_combinations(self):
+        """Test build_syllables_combinations function"""
+        syllables_words = {1: ['One'], 2: ['Seven'], 3: ['Eleven']}
+        self.assertEqual(build_syllables_combinations(syllables_words, 0), [[]])
+        self.assertEqual(
+            sorted(build_syllables_combinations(syllables_words, 3)), sorted([[1, 1, 1], [1, 2], [2, 1], [3]]))
+        self.assertEqual(build_syllables_combinations({2: ['Seven']}, 3), [])
+        # compositions starting with the prefix
+        self.assertEqual(sorted(build_syllables_combinations(syllables_words, 3, (1,))), sorted([[1, 1, 1], [1, 2]]))
+        self.assertEqual(build_syllables_combinations(syllables_words, 3, (1, 2)), [[1, 2]])
+        self.assertEqual(build_syllables_combinations(syllables_words, 3, (3,)), [[3]])
+        self.assertEqual(build_syllables_combinations(syllables_words, 2, (3,)), [])
+        self.assertEqual(build_syllables_combinations(syllables_words, 3, (4,)), [])
+        for syllables_num in range(1, 10):
+            self.assertTrue(verify_syllables_combinations(
+                syllables_words, syllables_num, build_syllables_combinations(syllables_words, syllables_num)))
+
+    def test_split_syllables_combinations(self):
+        """Test split_syllables_combinations and build_syllables_combinations_chunk functions"""
+        syllables_words = {1: ['One'], 2: ['Seven'], 3: ['Eleven']}
+        # small compositions are not split
+        self.assertEqual(split_syllables_combinations(syllables_words, 5, 4), [()])
+        self.assertEqual(split_syllables_combinations(syllables_words, 0, 4, min_chunk_size=0), [()])
+        for chunks_num in [1, 2, 3, 8, 100]:
+            prefixes = split_syllables_combinations(syllables_words, 12, chunks_num, min_chunk_size=0)
+            sizes = [count_syllables_combinations(syllables_words, 12 - sum(x)) for x in prefixes]
+            self.assertGreaterEqual(len(prefixes), min(chunks_num, count_syllables_combinations(syllables_words, 12)))
+            # chunks are not larger than 1 / chunks_num of all compositions
+            self.assertLessEqual(max(sizes), max(count_syllables_combinations(syllables_words, 12) // chunks_num, 1))
+            # chunks are all compositions
+            part_fn = 'compositions_test.part'
+            combinations = []
+            try:
+                for prefix in prefixes:
+                    chunk, start_time, end_time = build_syllables_combinations_chunk(
+                        (syllables_words, 12, prefix, part_fn))
+                    self.assertLessEqual(start_time, end_time)
+                    combinations.extend(load_syllables_combinations(part_fn))
+            finally:
+                os.remove(part_fn)
+            self.assertEqual(combinations, build_syllables_combinations(syllables_words, 12))
+
+    def test_load_syllables_combinations(self):
+        """Test save_syllables_combinations and load_syllables_combinations functions"""
+        fn = 'compositions_test.dat'
+        try:
+            save_syllables_combinations(fn, [[1, 2], [2, 1]])
+            self.assertEqual(load_syllables_combinations(fn), [[1, 2], [2, 1]])
+            # replace the existing file
+            save_syllables_combinations(fn, [[3]])
+            self.assertEqual(load_syllables_combinations(fn), [[3]])
+            # sequence of pickled lists
+            with open(fn, 'ab') as f:
+                pickle.dump([[1, 1, 1]], f, protocol=2)
+            self.assertEqual(load_syllables_combinations(fn), [[3], [1, 1, 1]])
+            # truncated file
+            with open(fn, 'rb') as f:
+                data = f.read()
+            with open(fn, 'wb') as f:
+                f.write(data[:-3])
+            with self.assertRaises(Exception):
+                load_syllables_combinations(fn)
+        finally:
+            os.remove(fn)
+
+    def test_verify_syllables_combinations(self):
+        """Test verify_syllables_combinations function"""
+        syllables_words = {1: ['One'], 2: ['Seven']}
+        self.assertTrue(verify_syllables_combinations(syllables_words, 3, [[1, 1, 1], [1, 2], [2, 1]]))
+        # missing combination
+        self.assertFalse(verify_syllables_combinations(syllables_words, 3, [[1, 1, 1], [1, 2]]))
+        # duplicated combination
+        self.assertFalse(verify_syllables_combinations(syllables_words, 3, [[1, 1, 1], [1, 2], [1, 2]]))
+        # wrong sum of syllables
+        self.assertFalse(verify_syllables_combinations(syllables_words, 3, [[1, 1, 1], [1, 2], [2, 2]]))
+        # no words with 3 syllables
+        self.assertFalse(verify_syllables_combinations(syllables_words, 3, [[1, 1, 1], [1, 2], [3]]))
+
+    def test_precompute_syllables_combinations(self):
+        """Test precompute_syllables_combinations function"""
+        syllables_words = {1: ['One'], 2: ['Seven'], 5: ['Fifty']}
+        fns = [get_syllables_combinations_filename(syllables_words, x) for x in range(5)]
+        for fn in fns:
+            if os.path.isfile(fn):
+                os.remove(fn)
+        try:
+            fn, status, _, size = verify_syllables_combinations_entry((syllables_words, 4))
+            self.assertEqual((fn, status, size), (fns[4], 'missing', 0))
+
+            results = precompute_syllables_combinations([syllables_words], range(5), processes=1)
+            self.assertEqual(sorted(x[0] for x in results), sorted(fns))
+            self.assertEqual([x[1] for x in results], ['built'] * 5)
+            self.assertEqual([x[3] for x in results], [os.path.getsize(x[0]) for x in results])
+            fn, status, _, _ = verify_syllables_combinations_entry((syllables_words, 4))
+            self.assertEqual((fn, status), (fns[4], 'verified'))
+
+            # rebuild corrupted and incomplete cache files
+            with open(fns[4], 'wb') as f:
+                f.write(b'corrupted')
+            save_syllables_combinations(fns[3], [[1, 2]])
+            fn, status, _, _ = verify_syllables_combinations_entry((syllables_words, 4))
+            self.assertEqual((fn, status), (fns[4], 'invalid'))
+            # the same lexicon twice is precomputed once
+            results = precompute_syllables_combinations([syllables_words, syllables_words], range(5), processes=2)
+            self.assertEqual(sorted(x[0] for x in results), sorted(fns))
+            self.assertEqual(sorted(x[1] for x in results), ['rebuilt'] * 2 + ['verified'] * 3)
+            for syllables_num in range(5):
+                self.assertEqual(
+                    sorted(get_syllables_combinations(syllables_words, syllables_num)),
+                    sorted(get_syllables_combinations(syllables_words, syllables_num, use_cache=False)))
+
+            # large entry is built in several chunks, which are joined into cache file
+            syllables_words = {1: [], 2: []}
+            fns.append(get_syllables_combinations_filename(syllables_words, 20))
+            self.assertGreater(len(split_syllables_combinations(syllables_words, 20, 4)), 1)
+            results = precompute_syllables_combinations([syllables_words], [20], processes=1)
+            self.assertEqual([x[:2] for x in results], [(fns[-1], 'built')])
+            self.assertEqual(
+                load_syllables_combinations(fns[-1]), build_syllables_combinations(syllables_words, 20))
+        finally:
+            for fn in fns:
+                if os.path.isfile(fn):
+                    os.remove(fn)
+
+    def test_find_poem(self):
+        """Test find_poem function"""
+        words_syllables = {
+            'One': 1,
+            'Seven': 2,
+            'Eleven': 3,
+        }
+        rhymes = [
+            {'Seven', 'Eleven'},
+        ]
+        syllables_words = invert_map(words_syllables)
+        syl_combinations = {3: [[1, 2], [3]]}
+
+        poem = find_poem(words_syllables, syllables_words, rhymes, syl_combinations, 'AA', [3, 3], 1)
+        self.assertIn(poem, [
+            [['One', 'Seven'], ['Eleven']],
+            [['Eleven'], ['One', 'Seven']],
+        ])
+        # no poem, because there is only one word with 1 syllable
+        poem = find_poem(words_syllables, syllables_words, rhymes, {3: [[1, 2]]}, 'AA', [3, 3], 1)
+        self.assertEqual(poem, [])
+
+    def test_iter_stanzas(self):
+        """Test iter_stanzas function"""
+        stanzas = list(iter_stanzas('AB', [3, 3], 1, False, stanzas_num=5))
+        self.assertEqual(len(stanzas), 5)
+        for stanza in stanzas:
+            words = sum(stanza, [])
+            # no words reuse within a stanza
+            self.assertEqual(len(words), len(set(words)))
+        # words of the previous two stanzas are not reused
+        stanzas = list(iter_stanzas('AB', [3, 3], 1, False, stanzas_num=5, cooldown=2))
+        self.assertEqual(len(stanzas), 5)
+        for prev_stanzas in zip(stanzas, stanzas[1:], stanzas[2:]):
+            words = sum(sum(prev_stanzas, []), [])
+            self.assertEqual(len(words), len(set(words)))
+        # endless stream of stanzas
+        stanzas = list(itertools.islice(iter_stanzas('A', [2], 1, False), 100))
+        self.assertEqual(len(stanzas), 100)
+        # only three pairs of rhymes with 1 syllable, so the stream stops after the third stanza
+        stanzas = list(iter_stanzas('AA', [1, 1], 1, False, stanzas_num=10, cooldown=10))
+        self.assertEqual(len(stanzas), 3)
+        # unless the cooldown is relaxed
+        stanzas = list(iter_stanzas('AA', [1, 1], 1, False, stanzas_num=10, cooldown=10, relax_cooldown=True))
+        self.assertEqual(len(stanzas), 10)
+        for prev_stanza, stanza in zip(stanzas, stanzas[1:]):
+            self.assertFalse(set(sum(prev_stanza, [])) & set(sum(stanza, [])))
+        # stream stops when the next stanza can't be generated even without cooldown
+        stanzas = list(iter_stanzas('AAA', [1, 1, 1], 1, False, stanzas_num=10, cooldown=10, relax_cooldown=True))
+        self.assertEqual(stanzas, [])
+        # cycle through the rhyme schemes of stanzas
+        stanzas = list(iter_stanzas(['AA', 'ABAB', 'A'], [2, 2, 3, 3, 3, 3, 4], 1, False, stanzas_num=7))
+        self.assertEqual([len(x) for x in stanzas], [2, 4, 1, 2, 4, 1, 2])
+        self.assertEqual([sum(WORDS_SYLLABLES[w] for w in x[-1]) for x in stanzas], [2, 3, 4, 2, 3, 4, 2])
+        # sonnet
+        stanzas = list(iter_stanzas(['ABAB', 'CDCD', 'EFEF', 'GG'], [10] * 14, 1, False, stanzas_num=4))
+        self.assertEqual([len(x) for x in stanzas], [4, 4, 4, 2])
+
+        with self.assertRaises(Exception):
+            next(iter_stanzas('AB', [1], 1, False))
+        with self.assertRaises(Exception):
+            next(iter_stanzas(['AB', 'A'], [1, 1], 1, False))
+        with self.assertRaises(Exception):
+            next(iter_stanzas(['A', ''], [1], 1, False))
+        with self.assertRaises(Exception):
+            next(iter_stanzas('A', [99999], 1, False))
+        with self.assertRaises(Exception):
+            next(iter_stanzas('A', [1], 1, False, cooldown=-1))
+        with self.assertRaises(Exception):
+            next(iter_stanzas('A', [1], 1, False, stanzas_num=0))
+        with self.assertRaises(Exception):
+            next(iter_stanzas('A', [1], 1, False, stanzas_num=-1))
 
     def test_is_rhyme(self):
         """Test is_rhyme function"""